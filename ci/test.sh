@@ -42,8 +42,15 @@ elif [ "${1-}" = container ]; then
     -v "$PWD/ci/test-conda:/test-conda:ro,z" \
     "$REPO2KANIKO_IMAGE" repo2docker $REPO2DOCKER_ARGS \
     ./test-conda
+elif [ "${1-}" = container-stream ]; then
+  # No shared workspace, the build context is sent to kaniko-runner
+  $ENGINE run --rm \
+    -v "$PWD/ci/test-conda:/test-conda:ro,z" \
+    "$REPO2KANIKO_IMAGE" repo2docker $REPO2DOCKER_ARGS \
+    --KanikoEngine.kaniko_stream_context=true \
+    ./test-conda
 else
-  echo "ERROR: Either 'container' or 'repo2docker' expected"
+  echo "ERROR: Either 'container', 'container-stream' or 'repo2docker' expected"
   exit 1
 fi
 echo "::endgroup::"
@@ -1,8 +1,10 @@
 package main
 
 import (
+	"archive/tar"
 	"bufio"
 	"encoding/base64"
+	"encoding/binary"
 	"encoding/json"
 	"errors"
 	"flag"
@@ -15,12 +17,19 @@ import (
 	"os/exec"
 	"path/filepath"
 	"strings"
+	"syscall"
 	"time"
 )
 
+// Maximum size of a JSON request
+const maxRequestLen = 16 << 20
+
 type inputRequest struct {
 	Command     []string           `json:"command"`
 	Credentials []inputCredentials `json:"credentials"`
+	// If set the build context is sent as an uncompressed tar of this many
+	// bytes immediately after the request
+	ContextTarLen int64 `json:"context_tar_len"`
 }
 
 type inputCredentials struct {
@@ -121,14 +130,149 @@ func saveDockerConfig(config dockerConfigAuths) error {
 	return nil
 }
 
-func handleConnection(conn net.Conn) error {
+// Check path resolves to a location inside realDest after following any
+// symlinks in the parts of path that already exist
+func checkInside(realDest string, path string) error {
+	existing := path
+	rest := ""
+	var resolved string
+	for {
+		r, err := filepath.EvalSymlinks(existing)
+		if err == nil {
+			resolved = filepath.Join(r, rest)
+			break
+		}
+		if !os.IsNotExist(err) {
+			return err
+		}
+		parent := filepath.Dir(existing)
+		if parent == existing {
+			resolved = path
+			break
+		}
+		rest = filepath.Join(filepath.Base(existing), rest)
+		existing = parent
+	}
+	if resolved != realDest && !strings.HasPrefix(resolved, realDest+string(os.PathSeparator)) {
+		return fmt.Errorf("path outside build context: %s", path)
+	}
+	return nil
+}
+
+// Extract a tar stream into dest
+func extractContext(r io.Reader, dest string) error {
+	realDest, err := filepath.EvalSymlinks(dest)
+	if err != nil {
+		return err
+	}
+	tr := tar.NewReader(r)
+	for {
+		hdr, err := tr.Next()
+		if err == io.EOF {
+			return nil
+		}
+		if err != nil {
+			return err
+		}
+
+		target := filepath.Join(dest, hdr.Name)
+		if target != dest && !strings.HasPrefix(target, dest+string(os.PathSeparator)) {
+			return fmt.Errorf("invalid path in build context: %s", hdr.Name)
+		}
+		if target != dest {
+			// An earlier symlink member could point a parent outside dest
+			if err := checkInside(realDest, filepath.Dir(target)); err != nil {
+				return err
+			}
+			if err := os.MkdirAll(filepath.Dir(target), 0755); err != nil {
+				return err
+			}
+		}
+
+		switch hdr.Typeflag {
+		case tar.TypeDir:
+			if err := os.MkdirAll(target, 0755); err != nil {
+				return err
+			}
+		case tar.TypeReg:
+			f, err := os.OpenFile(target, os.O_WRONLY|os.O_CREATE|os.O_TRUNC|syscall.O_NOFOLLOW, 0600)
+			if err != nil {
+				return err
+			}
+			_, err = io.Copy(f, tr)
+			if cerr := f.Close(); err == nil {
+				err = cerr
+			}
+			if err != nil {
+				return err
+			}
+		case tar.TypeSymlink:
+			if err := os.Symlink(hdr.Linkname, target); err != nil {
+				return err
+			}
+		case tar.TypeLink:
+			linkTarget := filepath.Join(dest, hdr.Linkname)
+			if err := checkInside(realDest, linkTarget); err != nil {
+				return err
+			}
+			if err := os.Link(linkTarget, target); err != nil {
+				return err
+			}
+		default:
+			log.Printf("Ignoring special file in build context: %s", hdr.Name)
+			continue
+		}
+
+		if err := os.Lchown(target, hdr.Uid, hdr.Gid); err != nil {
+			return err
+		}
+		if hdr.Typeflag == tar.TypeDir || hdr.Typeflag == tar.TypeReg {
+			if err := os.Chmod(target, hdr.FileInfo().Mode().Perm()); err != nil {
+				return err
+			}
+			if err := os.Chtimes(target, hdr.ModTime, hdr.ModTime); err != nil {
+				return err
+			}
+		}
+	}
+}
+
+func handleConnection(conn net.Conn, contextDir string) error {
 	defer conn.Close()
 
-	// Read the incoming command from the client
-	inputJson, err := bufio.NewReader(conn).ReadString('\n')
+	// Read the incoming command from the client, prefixed by its length as a
+	// 4 byte big-endian integer and followed by a newline.
+	// Any build context follows the request so must be read from the same
+	// buffered reader
+	reader := bufio.NewReader(conn)
+	first, err := reader.Peek(1)
 	if err != nil {
 		return err
 	}
+	if first[0] == '{' {
+		// Older clients send a newline terminated JSON request
+		err := errors.New("unsupported request format, repo2kaniko and kaniko-runner must be upgraded together")
+		returnError(conn, err)
+		return err
+	}
+	var inputLen uint32
+	if err := binary.Read(reader, binary.BigEndian, &inputLen); err != nil {
+		return err
+	}
+	if inputLen > maxRequestLen {
+		err := fmt.Errorf("request too large: %d bytes", inputLen)
+		returnError(conn, err)
+		return err
+	}
+	inputJson := make([]byte, inputLen)
+	if _, err := io.ReadFull(reader, inputJson); err != nil {
+		return err
+	}
+	if end, err := reader.ReadByte(); err != nil || end != '\n' {
+		err := errors.New("request not terminated by a newline")
+		returnError(conn, err)
+		return err
+	}
 
 	// input is a JSON object like:
 	// {
@@ -139,10 +283,11 @@ func handleConnection(conn net.Conn) error {
 	//		 "password": "password",
 	//		 "insecure": false
 	//   },
-	//   ...]
+	//   ...],
+	//   "context_tar_len": 12345
 	// }
 	var input inputRequest
-	if err := json.Unmarshal([]byte(inputJson), &input); err != nil {
+	if err := json.Unmarshal(inputJson, &input); err != nil {
 		returnError(conn, err)
 		return err
 	}
@@ -189,6 +334,36 @@ func handleConnection(conn net.Conn) error {
 		return err
 	}
 
+	if input.ContextTarLen > 0 {
+		buildContext, err := os.MkdirTemp(contextDir, "context-")
+		if err != nil {
+			returnError(conn, err)
+			return err
+		}
+		defer os.RemoveAll(buildContext)
+		// The prefix checks in extractContext need an absolute path
+		if buildContext, err = filepath.Abs(buildContext); err != nil {
+			returnError(conn, err)
+			return err
+		}
+
+		log.Printf("Receiving %d byte build context into %s", input.ContextTarLen, buildContext)
+		contextReader := io.LimitReader(reader, input.ContextTarLen)
+		if err := extractContext(contextReader, buildContext); err != nil {
+			// Consume the rest of the context so the client isn't reset
+			// before it can read the error
+			io.Copy(io.Discard, contextReader)
+			returnError(conn, err)
+			return err
+		}
+		// Discard any padding after the end of the archive
+		if _, err := io.Copy(io.Discard, contextReader); err != nil {
+			returnError(conn, err)
+			return err
+		}
+		input.Command = append(input.Command, "--context="+buildContext)
+	}
+
 	log.Printf("Running command: %s", input.Command)
 
 	// Run the command
@@ -232,6 +407,8 @@ func main() {
 	flag.StringVar(&listenAddr, "address", "tcp://localhost:8080", "address to listen on, e.g. unix:///tmp/go-runner.sock, tcp://localhost:8080")
 	var multiple bool
 	flag.BoolVar(&multiple, "multiple", false, "Keep listening after request finishes, not supported by Kaniko")
+	var contextDir string
+	flag.StringVar(&contextDir, "context-dir", "/workspace", "directory to extract build contexts sent over the connection into")
 	flag.Parse()
 
 	ln, err := listen(listenAddr)
@@ -246,9 +423,9 @@ func main() {
 		}
 
 		if multiple {
-			go handleConnection(conn) //nolint:errcheck
+			go handleConnection(conn, contextDir) //nolint:errcheck
 		} else {
-			err := handleConnection(conn)
+			err := handleConnection(conn, contextDir)
 			// Give the client some time to read the output before exiting
 			time.Sleep(2 * time.Second)
 			if err != nil {
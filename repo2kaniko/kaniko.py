@@ -1,12 +1,19 @@
 # Use Kaniko instead of Docker
+import codecs
+import errno
 import json
+import selectors
 import os
 import stat
 import shutil
 import socket
 import tarfile
-from tempfile import mkdtemp
-from traitlets import default, Bool, Dict, TraitError, Unicode, validate
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import lru_cache
+from tempfile import mkdtemp, NamedTemporaryFile, TemporaryDirectory, TemporaryFile
+from traitlets import default, Bool, Dict, Int, TraitError, Unicode, validate
 from urllib.parse import urlparse
 
 from repo2docker.engine import (
@@ -16,48 +23,480 @@ from repo2docker.engine import (
 from repo2podman.podman import (
     log_debug,
     log_info,
-    execute_cmd,
     exec_podman,
     exec_podman_stream,
 )
 
 
-def _copy_or_chmod_tree(src, dst=None):
+# Number of files handled by each task when copying in parallel
+_COPY_BATCH_SIZE = 256
+
+# Buffer size used when an in-kernel file copy isn't possible
+_COPY_BUFFER_SIZE = 1 << 20
+
+# Size of the buffer used to receive output from the Kaniko server
+_RECV_BUFFER_SIZE = 1 << 20
+
+# Number of characters at the end of the Kaniko output kept for checking the
+# final status and reporting errors
+_OUTPUT_TAIL_SIZE = 1024
+
+# Requested kernel socket receive buffer size for the Kaniko connection
+_SOCKET_RCVBUF_SIZE = 4 << 20
+
+# Permissions added so that Kaniko can read the build context if it's running
+# as a different user
+_DIR_MODE_EXTRA = 0o555
+_FILE_MODE_EXTRA = 0o444
+
+# Flags used to create files when extracting the build context, don't write
+# through a symlink member with the same name
+_EXTRACT_FILE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+
+# Flags used to open subdirectories relative to their parent, the directory
+# may have been replaced by a symlink since it was listed
+_SUBDIR_OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+
+# Maximum depth of directories kept open when walking a tree, deeper directories
+# are opened by path to limit the number of open file descriptors
+_MAX_OPEN_DEPTH = 64
+
+# Errors from copy_file_range or sendfile indicating another method should be tried
+_COPY_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+}
+
+
+@lru_cache(maxsize=None)
+def _default_authfile():
+    """
+    Registry authentication file, the home directory doesn't change so this
+    only needs to be looked up once
+    """
+    return os.path.join(os.path.expanduser("~"), ".docker", "config")
+
+
+def _copy_tree(src, dst, executor=None):
     """
     Similar to shutil.copytree, but
       - does not copy stat info (can cause problems when copying metadata such as selinux attributes)
       - ensures everything is world readable
-      - if there is no dst then just chmods src
+      - symlinks are copied as symlinks and are never followed
+
+    If executor is set files are copied in parallel using it.
+
+    Returns the number of files and directories under src.
     """
-    for item in os.listdir(src):
-        src_path = os.path.join(src, item)
-        if dst:
-            dst_path = os.path.join(dst, item)
-        else:
-            dst_path = None
-        src_permissions = stat.S_IMODE(os.lstat(src_path).st_mode)
-
-        if os.path.isdir(src_path):
-            if dst_path:
-                os.makedirs(dst_path)
-            os.chmod(
-                dst_path or src_path,
-                src_permissions
-                | stat.S_IRUSR
-                | stat.S_IRGRP
-                | stat.S_IROTH
-                | stat.S_IXUSR
-                | stat.S_IXGRP
-                | stat.S_IXOTH,
-            )
-            _copy_or_chmod_tree(src_path, dst_path)
+    # Walk the tree first, creating the destination directories since they
+    # must exist before anything can be copied into them
+    dirs = _scan_tree(src, dst)
+
+    # Copy the files in batches so that large directories can be
+    # split across threads
+    batches = []
+    for dir_src, dir_dst, files, _ in dirs:
+        for i in range(0, len(files), _COPY_BATCH_SIZE):
+            batches.append((dir_src, dir_dst, files[i : i + _COPY_BATCH_SIZE]))
+    if executor and len(batches) > 1:
+        futures = [executor.submit(_copy_files, *batch) for batch in batches]
+        # Wait for every batch before raising so nothing is still writing to
+        # dst if the caller cleans it up after an error
+        wait(futures)
+        for future in futures:
+            future.result()
+    else:
+        for batch in batches:
+            _copy_files(*batch)
+
+    # Change directory modes last, children before parents, in case the source
+    # directories aren't writeable
+    for _, dir_dst, _, subdirs in reversed(dirs):
+        if subdirs:
+            _chmod_dirs(dir_dst, subdirs)
+
+    return sum(len(files) + len(subdirs) for _, _, files, subdirs in dirs)
+
+
+def _scan_tree(src, dst):
+    """
+    List a directory tree and create the destination subdirectories.
+
+    Returns a list of
+    (src, dst, [(name, mode, is_symlink), ...], [(subdir, mode), ...])
+    with parent directories before their children.
+
+    The tree is walked with an explicit stack instead of recursion. Each
+    directory is listed completely when it's opened. Its file descriptors
+    stay open only while it has subdirectories left to visit, so the
+    subdirectories can be opened relative to it (the *at() family of
+    syscalls) and the kernel only resolves one path component. Below
+    _MAX_OPEN_DEPTH levels directories are opened by path instead, which
+    limits the number of open file descriptors. File types are taken from
+    os.scandir to avoid an lstat per entry.
+    """
+    dirs = []
+    # (src, dst, src_fd, dst_fd, iterator over subdirectories to visit)
+    stack = []
+
+    def visit(src, src_fd, dst, dst_fd):
+        # Takes ownership of src_fd and dst_fd
+        try:
+            subdirs = _list_dir(src, src_fd, dst, dst_fd, dirs)
+        except BaseException:
+            _close_dir_fds(src_fd, dst_fd)
+            raise
+        if subdirs and len(stack) < _MAX_OPEN_DEPTH:
+            stack.append((src, dst, src_fd, dst_fd, iter(subdirs)))
         else:
-            if dst_path:
-                shutil.copyfile(src_path, dst_path, follow_symlinks=False)
-            os.chmod(
-                dst_path or src_path,
-                src_permissions | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH,
+            _close_dir_fds(src_fd, dst_fd)
+            if subdirs:
+                stack.append((src, dst, None, None, iter(subdirs)))
+
+    src_fd, dst_fd = _open_dirs(src, None, dst, None, os.O_RDONLY | os.O_DIRECTORY)
+    visit(src, src_fd, dst, dst_fd)
+    try:
+        while stack:
+            src, dst, src_fd, dst_fd, subdirs = stack[-1]
+            name = next(subdirs, None)
+            if name is None:
+                stack.pop()
+                if src_fd is not None:
+                    _close_dir_fds(src_fd, dst_fd)
+                continue
+
+            if src_fd is None:
+                child_src = os.path.join(src, name)
+                child_dst = os.path.join(dst, name)
+                child_fds = _open_dirs(
+                    child_src, None, child_dst, None, os.O_RDONLY | os.O_DIRECTORY
+                )
+            else:
+                child_fds = _open_dirs(name, src_fd, name, dst_fd, _SUBDIR_OPEN_FLAGS)
+            visit(
+                os.path.join(src, name),
+                child_fds[0],
+                os.path.join(dst, name),
+                child_fds[1],
             )
+    finally:
+        for _, _, src_fd, dst_fd, _ in stack:
+            if src_fd is not None:
+                _close_dir_fds(src_fd, dst_fd)
+    return dirs
+
+
+def _list_dir(src, src_fd, dst, dst_fd, dirs):
+    """
+    List an open source directory, append its entry to dirs (see _scan_tree)
+    and create its subdirectories in the destination.
+    Returns the names of the subdirectories.
+    """
+    files = []
+    subdirs = []
+    dirs.append((src, dst, files, subdirs))
+    with os.scandir(src_fd) as it:
+        for entry in it:
+            name = entry.name
+            if entry.is_symlink():
+                files.append((name, None, True))
+                continue
+
+            mode = stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode)
+            if not entry.is_dir(follow_symlinks=False):
+                if not entry.is_file(follow_symlinks=False):
+                    raise shutil.SpecialFileError(
+                        f"{os.path.join(src, name)} is not a regular file"
+                    )
+                files.append((name, mode, False))
+                continue
+
+            subdirs.append((name, mode))
+            os.mkdir(name, dir_fd=dst_fd)
+    return [name for name, _ in subdirs]
+
+
+def _open_dirs(src, src_dir_fd, dst, dst_dir_fd, flags):
+    """
+    Open a source and destination directory, returns (src_fd, dst_fd)
+    """
+    src_fd = os.open(src, flags, dir_fd=src_dir_fd)
+    try:
+        dst_fd = os.open(dst, flags, dir_fd=dst_dir_fd)
+    except BaseException:
+        os.close(src_fd)
+        raise
+    return src_fd, dst_fd
+
+
+def _close_dir_fds(src_fd, dst_fd):
+    os.close(src_fd)
+    if dst_fd is not None:
+        os.close(dst_fd)
+
+
+def _copy_files(src, dst, files):
+    """
+    Copy files from directory src to dst and make them world readable
+    """
+    src_fd = os.open(src, os.O_RDONLY | os.O_DIRECTORY)
+    dst_fd = None
+    try:
+        dst_fd = os.open(dst, os.O_RDONLY | os.O_DIRECTORY)
+        for name, mode, is_symlink in files:
+            if is_symlink:
+                # Symlink permissions can't be changed on Linux
+                os.symlink(os.readlink(name, dir_fd=src_fd), name, dir_fd=dst_fd)
+                continue
+            _fast_copy(name, name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+            os.chmod(name, mode | _FILE_MODE_EXTRA, dir_fd=dst_fd)
+    finally:
+        _close_dir_fds(src_fd, dst_fd)
+
+
+def _fast_copy(src, dst, *, src_dir_fd=None, dst_dir_fd=None):
+    """
+    Copy the contents of file src to dst, keeping the data in the kernel
+    where possible.
+
+    Tries copy_file_range (which may also do a server-side copy or reflink),
+    then sendfile, then falls back to a read/write loop with a 1 MiB buffer.
+    """
+    src_fd = os.open(src, os.O_RDONLY, dir_fd=src_dir_fd)
+    try:
+        dst_fd = os.open(
+            dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666, dir_fd=dst_dir_fd
+        )
+        try:
+            size = os.fstat(src_fd).st_size
+            blocksize = max(size, _COPY_BUFFER_SIZE)
+            # os.copy_file_range was added in Python 3.8 and is Linux only.
+            # Both syscalls use and update the current file offsets, so if
+            # one fails part way through the next method carries on from
+            # where it stopped.
+            copy_file_range = getattr(os, "copy_file_range", None)
+            if copy_file_range and _copy_with(
+                copy_file_range, src_fd, dst_fd, size, blocksize
+            ):
+                return
+            sendfile = getattr(os, "sendfile", None)
+            if sendfile and _copy_with(
+                lambda s, d, n: sendfile(d, s, None, n),
+                src_fd,
+                dst_fd,
+                size,
+                blocksize,
+            ):
+                return
+            buf = memoryview(bytearray(_COPY_BUFFER_SIZE))
+            with open(src_fd, "rb", buffering=0, closefd=False) as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    written = 0
+                    while written < n:
+                        written += os.write(dst_fd, buf[written:n])
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _copy_with(copy, src_fd, dst_fd, size, blocksize):
+    """
+    Repeatedly call copy(src_fd, dst_fd, blocksize) until it returns 0.
+    Returns False if the method isn't supported for these files.
+    """
+    copied = 0
+    try:
+        while True:
+            n = copy(src_fd, dst_fd, blocksize)
+            if not n:
+                break
+            copied += n
+    except OSError as e:
+        if e.errno in _COPY_FALLBACK_ERRNOS:
+            return False
+        raise
+    # Some filesystems (e.g. procfs, some FUSE) report EOF without copying
+    # anything, let the next method try
+    return copied > 0 or size == 0
+
+
+def _chmod_dirs(parent, subdirs):
+    """
+    Make subdirectories of parent world readable and executable
+    """
+    parent_fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for name, mode in subdirs:
+            os.chmod(name, mode | _DIR_MODE_EXTRA, dir_fd=parent_fd)
+    finally:
+        os.close(parent_fd)
+
+
+def _extract_tar(fileobj, dst):
+    """
+    Extract a tar stream into directory dst in a single pass, making
+    everything world readable.
+
+    The tar may be compressed. Unlike TarFile.extractall this doesn't require
+    a seekable file, and file attributes are set on the open file descriptor
+    as each file is written instead of by path afterwards.
+
+    Returns the number of members extracted.
+    """
+    # Member paths are normalised so dst must be too
+    dst = os.path.abspath(dst)
+    owner = os.geteuid() == 0
+    real_dst = os.path.realpath(dst)
+    # Directories known to exist, to avoid checking and creating the parents
+    # of every member
+    made = {dst}
+    # Directory attributes are set last in case they aren't writeable
+    dirs = []
+    # Parent directories without their own tar member
+    implicit_dirs = []
+    n = 0
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tarf:
+        for ti in tarf:
+            n += 1
+            path = _tar_member_path(dst, ti.name)
+            if path != dst:
+                parent = os.path.dirname(path)
+                if parent not in made:
+                    # An earlier symlink member could point a parent outside dst
+                    _check_inside(real_dst, parent, ti.name)
+                    implicit_dirs.extend(_make_parents(parent, made))
+
+            if ti.isdir():
+                try:
+                    os.mkdir(path)
+                except FileExistsError:
+                    pass
+                made.add(path)
+                dirs.append((path, ti))
+            elif ti.isreg():
+                fd = os.open(path, _EXTRACT_FILE_FLAGS, 0o600)
+                with open(fd, "wb") as out:
+                    shutil.copyfileobj(tarf.extractfile(ti), out, _COPY_BUFFER_SIZE)
+                    out.flush()
+                    if owner:
+                        os.fchown(fd, ti.uid, ti.gid)
+                    os.fchmod(fd, ti.mode | _FILE_MODE_EXTRA)
+                    os.utime(fd, (ti.mtime, ti.mtime))
+            elif ti.issym():
+                if os.path.lexists(path):
+                    os.unlink(path)
+                os.symlink(ti.linkname, path)
+                if owner:
+                    os.chown(path, ti.uid, ti.gid, follow_symlinks=False)
+            elif ti.islnk():
+                # Hard link targets are always earlier in the stream
+                target = _tar_member_path(dst, ti.linkname)
+                _check_inside(real_dst, target, ti.linkname)
+                os.link(target, path, follow_symlinks=False)
+            else:
+                log_debug(f"Ignoring special file {ti.name} in build context")
+
+    for path in implicit_dirs:
+        os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) | _DIR_MODE_EXTRA)
+    for path, ti in reversed(dirs):
+        if owner:
+            os.chown(path, ti.uid, ti.gid)
+        os.chmod(path, ti.mode | _DIR_MODE_EXTRA)
+        os.utime(path, (ti.mtime, ti.mtime))
+    return n
+
+
+def _tar_member_path(dst, name):
+    """
+    Get the path to extract a tar member to, which must be inside dst
+    """
+    name = os.path.normpath(name)
+    if os.path.isabs(name) or name == os.pardir or name.startswith(os.pardir + os.sep):
+        raise ValueError(f"Build context contains a path outside the context: {name}")
+    return os.path.normpath(os.path.join(dst, name))
+
+
+def _check_inside(real_dst, path, name):
+    """
+    Check path resolves to a location inside real_dst after following symlinks
+    """
+    real_path = os.path.realpath(path)
+    if real_path != real_dst and not real_path.startswith(real_dst + os.sep):
+        raise ValueError(f"Build context contains a path outside the context: {name}")
+
+
+def _make_parents(path, made):
+    """
+    Create directory path and any missing parents up to a directory in made
+    or the root. Returns the directories that were created.
+    """
+    missing = []
+    while path not in made:
+        missing.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    created = []
+    for path in reversed(missing):
+        try:
+            os.mkdir(path)
+            created.append(path)
+        except FileExistsError:
+            pass
+        made.add(path)
+    return created
+
+
+def _merge_authfiles(authfile, sources):
+    """
+    Add the registry credentials in the sources auth files to authfile
+    """
+    try:
+        with open(authfile) as f:
+            auth = json.load(f)
+    except FileNotFoundError:
+        auth = {}
+    auths = auth.setdefault("auths", {})
+    for source in sources:
+        with open(source) as f:
+            auths.update(json.load(f).get("auths", {}))
+    parent = os.path.dirname(authfile)
+    os.makedirs(parent, mode=0o700, exist_ok=True)
+    # Replace the file atomically, it contains credentials so keep it private
+    with NamedTemporaryFile("w", dir=parent, delete=False) as f:
+        try:
+            json.dump(auth, f, indent=2)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, authfile)
+
+
+def _send_buffers(sock, buffers):
+    """
+    Send all buffers in order without concatenating them
+    """
+    buffers = [memoryview(b) for b in buffers if b]
+    if not hasattr(sock, "sendmsg"):
+        for b in buffers:
+            sock.sendall(b)
+        return
+    while buffers:
+        # sendmsg may send only part of the data
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
 
 
 class KanikoEngine(ContainerEngine):
@@ -101,6 +540,16 @@ class KanikoEngine(ContainerEngine):
             value += os.path.sep
         return value
 
+    kaniko_stream_context = Bool(
+        False,
+        help=(
+            "Send the build context to the Kaniko server over its connection "
+            "instead of writing it to kaniko_build_path, so no shared "
+            "directory is needed. Requires a kaniko-runner that supports it."
+        ),
+        config=True,
+    )
+
     login_executable = Unicode(
         "skopeo",
         help="The executable to use for registry login.",
@@ -171,9 +620,28 @@ class KanikoEngine(ContainerEngine):
         config=True,
     )
 
+    copy_concurrency = Int(
+        1,
+        help=(
+            "Number of threads used to copy the build context into "
+            "kaniko_build_path. Set to 0 to choose automatically."
+        ),
+        config=True,
+    )
+
     def __init__(self, *, parent):
         super().__init__(parent=parent)
 
+        # Shared by everything that runs in parallel so that threads are
+        # reused and the total number is limited
+        workers = self.copy_concurrency
+        if workers < 1:
+            workers = min(32, (os.cpu_count() or 1) * 4)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max(workers, 2), thread_name_prefix="kaniko-io"
+        )
+        weakref.finalize(self, self._pool.shutdown, wait=False)
+
         if self.kaniko_address:
             self._s = self._connect()
         else:
@@ -185,11 +653,17 @@ class KanikoEngine(ContainerEngine):
 
     def _connect(self):
         url = urlparse(self.kaniko_address)
+        # The receive buffer must be set before connecting so that a large
+        # enough TCP window can be negotiated
         if url.scheme == "tcp":
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_RCVBUF_SIZE)
+            # Don't delay sending the request
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             s.connect((url.hostname, url.port))
         elif url.scheme == "unix":
             s = socket.socket(socket.AF_UNIX)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_RCVBUF_SIZE)
             s.connect(url.path)
         else:
             raise ValueError(f"Unsupported kaniko_address scheme {url.scheme}")
@@ -197,24 +671,44 @@ class KanikoEngine(ContainerEngine):
 
     def _create_build_context(self, fileobj, srcpath, builddir):
         if fileobj:
-            tarf = tarfile.open(fileobj=fileobj)
-            tarf.extractall(builddir)
-            log_debug(builddir)
+            n = _extract_tar(fileobj, builddir)
+        elif srcpath:
+            executor = self._pool if self.copy_concurrency != 1 else None
+            n = _copy_tree(srcpath, builddir, executor=executor)
+        else:
+            raise ValueError("No fileobj or srcpath")
+        log_debug(f"Created build context {builddir} with {n} entries")
 
-            lines = execute_cmd(["ls", "-lRa", builddir], capture="stdout")
-            log_debug(lines)
-            # Ensure it is world readable since Kaniko may be running as a different user
-            _copy_or_chmod_tree(builddir)
+    @contextmanager
+    def _context_tar(self, fileobj, srcpath):
+        """
+        Get the build context as a seekable tar file
+        """
+        if fileobj:
+            yield fileobj
         elif srcpath:
-            _copy_or_chmod_tree(srcpath, builddir)
+            with TemporaryFile() as f:
+                with tarfile.open(fileobj=f, mode="w") as tarf:
+                    tarf.add(srcpath, arcname=".")
+                f.seek(0)
+                yield f
         else:
             raise ValueError("No fileobj or srcpath")
 
-    def _run_external_kaniko(self, cmdargs):
+    def _run_external_kaniko(self, cmdargs, context=None):
+        """
+        Run Kaniko on the Kaniko server. If context is a tar file it's sent
+        after the request instead of using a shared build directory.
+        """
         input = {
             "command": [self.kaniko_executable] + cmdargs,
             "credentials": [],
         }
+        if context:
+            context_offset = context.tell()
+            context_len = context.seek(0, os.SEEK_END) - context_offset
+            context.seek(context_offset)
+            input["context_tar_len"] = context_len
         # Dict with fields
         # - registry
         # - Either username and password
@@ -229,23 +723,59 @@ class KanikoEngine(ContainerEngine):
             **input,
             "credentials": [r["registry"] for r in input["credentials"]],
         }
-        message = json.dumps(input) + "\n"
+        body = json.dumps(input).encode()
         log_debug(f"Sending {self.kaniko_address}: {debug_input}\n")
-        self._s.sendall(message.encode())
-
-        # Receive data
-        last_chunk = ""
-        while True:
-            chunk = self._s.recv(1024000)
-            if chunk:
-                last_chunk = chunk.decode()
-                yield last_chunk
-            else:
-                break
+        # The request is prefixed by its length as a 4 byte big-endian integer.
+        # The trailing newline makes an older kaniko-runner, which expects a
+        # newline terminated request, fail instead of waiting forever.
+        _send_buffers(self._s, [len(body).to_bytes(4, "big"), body, b"\n"])
+        if context:
+            try:
+                # Uses os.sendfile if context is a real file
+                self._s.sendfile(context, context_offset, context_len)
+            except (BrokenPipeError, ConnectionResetError) as e:
+                # The runner stopped reading the context, read its error below
+                log_debug(f"Sending build context interrupted: {e}\n")
+
+        # Receive data into a reused buffer. Use an incremental decoder since
+        # a multi-byte character may be split across chunks.
+        buf = memoryview(bytearray(_RECV_BUFFER_SIZE))
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        # The end of the output, large socket buffers mean the final status
+        # line may arrive in the same chunk as earlier output
+        tail = ""
+        # Linux only, acknowledge the start of the output immediately instead
+        # of waiting to piggyback the ACK on data we're never going to send
+        quickack = self._s.family == socket.AF_INET and hasattr(socket, "TCP_QUICKACK")
+        # Wait for output then read everything that's available before
+        # yielding, so bursts of small writes are returned together
+        self._s.setblocking(False)
+        eof = False
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._s, selectors.EVENT_READ)
+            while not eof:
+                selector.select()
+                n = 0
+                while n < len(buf):
+                    try:
+                        received = self._s.recv_into(buf[n:])
+                    except BlockingIOError:
+                        break
+                    if not received:
+                        eof = True
+                        break
+                    n += received
+                if quickack and n:
+                    self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                    quickack = False
+                text = decoder.decode(buf[:n], eof)
+                if text:
+                    tail = (tail + text)[-_OUTPUT_TAIL_SIZE:]
+                    yield text
 
         self._s.close()
-        if last_chunk != "status: SUCCESS\n":
-            raise RuntimeError(f"Kaniko build failed: {last_chunk}")
+        if not f"\n{tail}".endswith("\nstatus: SUCCESS\n"):
+            raise RuntimeError(f"Kaniko build failed: {tail}")
 
     def build(
         self,
@@ -301,6 +831,9 @@ class KanikoEngine(ContainerEngine):
 
         ## Kaniko specific args
 
+        # Registry logins, only needed when running Kaniko locally
+        logins = []
+
         # Kaniko uses a registry as a cache
         if self.cache_registry:
             cache_registry_host = self.cache_registry.split("/")[0]
@@ -320,7 +853,7 @@ class KanikoEngine(ContainerEngine):
                 if not cache_credentials.get("registry"):
                     cache_credentials["registry"] = cache_registry_host
                 if not self._s:
-                    self._login(**cache_credentials)
+                    logins.append(cache_credentials)
 
         if self.cache_dir:
             cmdargs.append(f"--cache-dir={self.cache_dir}")
@@ -328,18 +861,25 @@ class KanikoEngine(ContainerEngine):
         # Kaniko builds and pushes in one command
         if self.push_image:
             if self.registry_credentials and not self._s:
-                self._login(**self.registry_credentials)
+                logins.append(self.registry_credentials)
         else:
             cmdargs.append("--no-push")
 
+        self._login_all(logins)
+
         # Avoid try-except so that if build errors occur they don't result in a
         # confusing message about an exception whilst handling an exception
-        if self.kaniko_address:
+        if self.kaniko_address and self.kaniko_stream_context:
+            # The Kaniko server adds --context
+            with self._context_tar(fileobj, path) as context:
+                for line in self._run_external_kaniko(cmdargs, context):
+                    yield line
+        elif self.kaniko_address:
             builddir = mkdtemp(dir=self.kaniko_build_path)
             try:
                 self._create_build_context(fileobj, path, builddir)
                 cmdargs.extend(
-                    ["--context", f"/workspace/{os.path.split(builddir)[1]}"]
+                    ["--context", f"/workspace/{os.path.basename(builddir)}"]
                 )
                 for line in self._run_external_kaniko(cmdargs):
                     yield line
@@ -362,6 +902,33 @@ class KanikoEngine(ContainerEngine):
     def inspect_image(self, image):
         raise NotImplementedError("kaniko inspect_image not supported")
 
+    def _login_all(self, logins):
+        """
+        Login to each registry in logins, a list of _login kwargs.
+        """
+        if len(logins) < 2:
+            for kw in logins:
+                self._login(**kw)
+            return
+        # skopeo rewrites the whole auth file, so concurrent logins each use
+        # their own temporary file and the results are merged afterwards
+        authfiles = {}
+        with TemporaryDirectory() as tmpdir:
+            futures = []
+            for i, kw in enumerate(logins):
+                authfile = kw.get("authfile") or _default_authfile()
+                tmpfile = os.path.join(tmpdir, f"auth-{i}.json")
+                authfiles.setdefault(authfile, []).append(tmpfile)
+                futures.append(
+                    self._pool.submit(self._login, **{**kw, "authfile": tmpfile})
+                )
+            wait(futures)
+            # Propagate any exceptions
+            for future in futures:
+                future.result()
+            for authfile, tmpfiles in authfiles.items():
+                _merge_authfiles(authfile, tmpfiles)
+
     def _login(self, **kwargs):
         # kaniko doesn't support login, docker CLI doesn't support insecure, so use skopeo
         args = ["login"]
@@ -375,6 +942,8 @@ class KanikoEngine(ContainerEngine):
                 password = v
             elif k == "registry":
                 registry = v
+            elif k == "authfile":
+                authfile = v
             elif v is None:
                 args.append(f"--{k}")
             else:
@@ -384,7 +953,7 @@ class KanikoEngine(ContainerEngine):
             args.append("--password-stdin")
 
         if authfile is None:
-            authfile = os.path.join(os.path.expanduser("~"), ".docker", "config")
+            authfile = _default_authfile()
         args.append(f"--authfile={authfile}")
 
         if registry is not None: